@@ -3,22 +3,61 @@ FastAPI Prediction Server for Lahore Temperature Prediction
 """
 
 import os
+
+# Inference threads already come from the executor below; keep BLAS/OpenMP
+# single-threaded so they do not oversubscribe the cores (must precede numpy).
+# Scale out with WEB_CONCURRENCY=N (read by uvicorn as --workers), N = number of
+# physical cores, so each worker's Numba pool gets its share of the cores.
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+os.environ.setdefault('MKL_NUM_THREADS', '1')
+os.environ.setdefault(
+    'NUMBA_NUM_THREADS', str(max(1, (os.cpu_count() or 1) // int(os.getenv('WEB_CONCURRENCY', '1'))))
+)
+
 import sys
-import glob
+import json
+import hashlib
+import tempfile
+import asyncio
+import threading
+from contextlib import nullcontext
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 from datetime import datetime
 import time
 
-import mlflow
-import mlflow.sklearn
-import pandas as pd
 import numpy as np
-from fastapi import FastAPI, HTTPException
+import orjson
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from starlette.responses import Response
 
+# Optional: ONNX Runtime inference for the loaded sklearn model (skl2onnx is
+# imported at conversion time, it pulls in sklearn and pandas)
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+# POSIX file locks serialise shared statistics flushes across uvicorn workers
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Optional: Numba JIT for the drift statistics and forest traversal kernels
+try:
+    from numba import njit, prange, threading_layer
+except ImportError:
+    njit = None
+    prange = range
+
 # Add project root to path
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.append(str(PROJECT_ROOT))
@@ -27,21 +66,99 @@ sys.path.append(str(PROJECT_ROOT))
 MLFLOW_TRACKING_URI = os.getenv('MLFLOW_TRACKING_URI', 'file:./mlruns')
 MODEL_NAME = os.getenv('MODEL_NAME', 'lahore_temperature_predictor_random_forest')
 MODEL_STAGE = os.getenv('MODEL_STAGE', 'Production')
+MAX_BATCH = int(os.getenv('MAX_BATCH', '64'))
+BATCH_WINDOW_SECONDS = float(os.getenv('BATCH_WINDOW_SECONDS', '0.003'))
+FEATURE_STATS_SHM = os.getenv('FEATURE_STATS_SHM', 'lahore_feature_stats')  # Empty: per-worker stats
+STATS_FLUSH_INTERVAL = int(os.getenv('STATS_FLUSH_INTERVAL', '32'))
+PREDICTION_CACHE_SIZE = int(os.getenv('PREDICTION_CACHE_SIZE', '8192'))  # 0 disables the cache
+PREDICT_BATCH_MAX_ROWS = int(os.getenv('PREDICT_BATCH_MAX_ROWS', '100000'))
+FOREST_ROW_PARALLEL_MIN = 64  # Batches this large are split across threads by row, see _forest_predict
+RESOLVED_MODEL_FILE = '.resolved_model.json'  # Sidecar in the tracking dir, see load_model
+
+# Derived once so repeated load_model calls (reloads) skip the string work
+_TRACKING_PATH = os.path.abspath(MLFLOW_TRACKING_URI.removeprefix('file://').removeprefix('file:'))
+_RESOLVED_MODEL_PATH = os.path.join(_TRACKING_PATH, RESOLVED_MODEL_FILE)
+_REGISTRY_DIR = os.path.join(_TRACKING_PATH, 'models', MODEL_NAME)
+_HAS_MODEL_STAGE = bool(MODEL_STAGE) and MODEL_STAGE != 'None'
+# Registry lookup order: MODEL_STAGE first, then any stage
+_STAGE_LIST = list(dict.fromkeys(stage for stage in [MODEL_STAGE, 'Staging', 'None', 'Production'] if stage))
+_STAGE_RANKS = {stage.lower(): i for i, stage in enumerate(_STAGE_LIST)}
 
 # Initialize FastAPI
-app = FastAPI(title="Lahore Temperature Prediction API", version="1.0.0")
+app = FastAPI(
+    title="Lahore Temperature Prediction API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
 
 # Prometheus Metrics
 REQUEST_COUNT = Counter('prediction_requests_total', 'Total prediction requests', ['status'])
-INFERENCE_LATENCY = Histogram('prediction_latency_seconds', 'Prediction latency')
+INFERENCE_LATENCY = Histogram(
+    'prediction_latency_seconds', 'Prediction latency',
+    # Fine below ~0.1s (single-sample regime); 1.0/2.5 keep the 0.5s p95 alert resolvable
+    buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5, 1.0, 2.5)
+)
+# /predict_batch gets its own metrics so offline scoring runs do not skew the
+# single-row latency and error-rate alerts
+BATCH_REQUEST_COUNT = Counter('batch_prediction_requests_total', 'Total batch prediction requests', ['status'])
+BATCH_LATENCY = Histogram(
+    'batch_prediction_latency_seconds', 'Batch prediction latency',
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+)
 DATA_DRIFT_DETECTIONS = Counter('data_drift_detections_total', 'Total data drift detections', ['feature'])
 DRIFT_RATIO = Histogram('data_drift_ratio', 'Ratio of out-of-distribution features per request', buckets=[0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0])
 
+# Label children resolved once; per-feature drift children follow the model (DRIFT_CHILDREN)
+REQ_OK = REQUEST_COUNT.labels(status='success')
+REQ_ERR = REQUEST_COUNT.labels(status='error')
+BATCH_REQ_OK = BATCH_REQUEST_COUNT.labels(status='success')
+BATCH_REQ_ERR = BATCH_REQUEST_COUNT.labels(status='error')
+
 # Global model
 model = None
 feature_names = None
 model_version = "N/A"
-feature_statistics = None  # Store feature statistics for drift detection
+
+# The model is loaded by the first /predict rather than at startup (see ensure_model_loaded)
+_LOAD_LOCK = asyncio.Lock()
+_load_attempted = False
+
+# Running feature statistics for drift detection (Welford), one slot per feature.
+# _count/_mean/_m2 live in shared memory so every uvicorn worker sees the same
+# statistics; each worker accumulates into the _pending_* arrays and merges them
+# in every STATS_FLUSH_INTERVAL requests under a file lock.
+_count = None
+_mean = None
+_m2 = None
+_pending_count = None
+_pending_mean = None
+_pending_m2 = None
+_pending_rows = 0
+_drift_mask = None
+_stats_shm = None
+_stats_lock_file = None
+DRIFT_CHILDREN = None  # DATA_DRIFT_DETECTIONS children in feature order
+
+FEATURE_INDEX = None  # feature name -> column position in the model input
+SESSION = None  # ONNX Runtime session compiled from the model, if available
+SESSION_OUTPUT = None
+FOREST = None  # Packed float32 SoA copy of the forest for the Numba kernel, if available
+LEAF_VALUES = None  # (tree, leaf values) pairs for the apply-based sklearn fallback
+
+# Micro-batching: /predict enqueues one row and awaits a future resolved by the
+# batch worker, which runs coalesced rows through model.predict off the event loop
+_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+_BATCH_QUEUE = None
+_batch_worker_task = None
+_batch_tasks = set()
+
+# LRU of predictions keyed on the feature row rounded to 4 decimals; only touched
+# from the event loop, so it needs no lock
+_prediction_cache = OrderedDict()
+
+# Response timestamp, reformatted at most once per millisecond (see current_timestamp)
+CURRENT_TS = datetime.utcnow().isoformat()
+_ts_refreshed = time.monotonic()
 
 
 class PredictionRequest(BaseModel):
@@ -54,88 +171,180 @@ class PredictionResponse(BaseModel):
     model_version: Optional[str] = None
 
 
+class BatchPredictionRequest(BaseModel):
+    features: List[Dict[str, float]] = Field(..., description="Feature values, one mapping per row")
+
+
+class BatchPredictionResponse(BaseModel):
+    predictions: List[float]
+    timestamp: str
+    model_version: Optional[str] = None
+
+
+def _registry_mtime() -> Optional[float]:
+    """mtime of the file-store registry entry for MODEL_NAME (changes on new versions)"""
+    return os.path.getmtime(_REGISTRY_DIR) if os.path.isdir(_REGISTRY_DIR) else None
+
+
+def read_resolved_model() -> Optional[dict]:
+    """
+    Read the model resolution cached by a previous start. It is stale if the
+    artifacts or registry changed since, or if MODEL_NAME/MODEL_STAGE differ.
+    
+    Returns:
+        dict with model_path/version/stage, or None if missing or stale
+    """
+    try:
+        with open(_RESOLVED_MODEL_PATH) as f:
+            resolved = json.load(f)
+        if (resolved['model_name'] != MODEL_NAME
+                or resolved['model_stage'] != MODEL_STAGE
+                or os.path.getmtime(resolved['model_path']) != resolved['mtime']
+                or _registry_mtime() != resolved['registry_mtime']):
+            return None
+        return resolved
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_resolved_model(model_path: str, version, stage):
+    """Cache the resolved model so the next start can skip the registry lookup"""
+    try:
+        with open(_RESOLVED_MODEL_PATH, 'w') as f:
+            json.dump({
+                'model_name': MODEL_NAME,
+                'model_stage': MODEL_STAGE,
+                'model_path': model_path,
+                'version': str(version),
+                'stage': str(stage),
+                'mtime': os.path.getmtime(model_path),
+                'registry_mtime': _registry_mtime()
+            }, f)
+    except OSError as e:
+        print(f"  Note: Could not cache model resolution: {e}")
+
+
+def find_first_artifact(root: str) -> Optional[str]:
+    """Return the first {root}/{experiment_id}/models/{model_id}/artifacts directory"""
+    try:
+        experiments = os.scandir(root)
+    except OSError:
+        return None
+    
+    with experiments:
+        for exp in experiments:
+            if not exp.is_dir():
+                continue
+            models_dir = os.path.join(exp.path, 'models')
+            try:
+                models = os.scandir(models_dir)
+            except OSError:
+                continue
+            with models:
+                for m in models:
+                    artifacts = os.path.join(m.path, 'artifacts')
+                    if os.path.isdir(artifacts):
+                        return artifacts
+    return None
+
+
 def load_model():
-    """Load model from MLflow"""
-    global model, feature_names, model_version, feature_statistics
+    """
+    Load model from MLflow. Everything is built in locals and published with
+    the global model last, so requests that see a model (ensure_model_loaded's
+    fast path) never see a half-initialised one.
+    """
+    global model, feature_names, model_version, FEATURE_INDEX, SESSION, SESSION_OUTPUT, FOREST, LEAF_VALUES
+    
+    # Deferred to the (lazy) load: mlflow and sklearn.ensemble pull in pandas
+    import mlflow
+    import mlflow.sklearn
     
     print("Loading model from MLflow...")
     mlflow.set_tracking_uri(MLFLOW_TRACKING_URI)
     
     try:
-        from mlflow.tracking import MlflowClient
-        client = MlflowClient()
-        
-        # Try to get model from registry
-        # First, search for registered models
-        registered_models = client.search_registered_models(filter_string=f"name='{MODEL_NAME}'")
-        
-        if not registered_models:
-            raise ValueError(f"Model {MODEL_NAME} not found in registry")
-        
-        # Get model versions - try Production first, then any stage
-        model_versions = []
-        if MODEL_STAGE and MODEL_STAGE != 'None':
-            try:
-                model_versions = client.get_latest_versions(MODEL_NAME, stages=[MODEL_STAGE])
-            except:
-                pass
-        
-        if not model_versions:
-            try:
-                model_versions = client.get_latest_versions(MODEL_NAME, stages=["None", "Staging", "Production"])
-            except:
-                model_versions = client.get_latest_versions(MODEL_NAME, stages=["None"])
+        # A previous start may already have resolved the model; if neither the
+        # artifacts nor the registry changed since, skip the registry entirely
+        resolved = read_resolved_model()
         
-        if not model_versions:
-            raise ValueError(f"Model {MODEL_NAME} not found in registry")
+        if resolved:
+            print(f"  Loading cached model resolution: {resolved['model_path']}")
+            loaded = mlflow.sklearn.load_model(resolved['model_path'])
+            version = f"{resolved['version']} (Stage: {resolved['stage']})"
+        else:
+            from mlflow.tracking import MlflowClient
+            client = MlflowClient()
+            
+            # Get model versions in one registry call - MODEL_STAGE first, then any stage
+            model_versions = client.get_latest_versions(MODEL_NAME, stages=_STAGE_LIST)
+            
+            if not model_versions:
+                raise ValueError(f"Model {MODEL_NAME} not found in registry")
+            
+            best_model = min(
+                model_versions, key=lambda v: _STAGE_RANKS.get(str(v.current_stage).lower(), len(_STAGE_RANKS))
+            )
+            stage = best_model.current_stage if hasattr(best_model, 'current_stage') else MODEL_STAGE
+            
+            # Try to load model - handle Windows path issues in containers
+            # Find model artifact directory directly (avoids Windows path issues)
+            # Model registry stores models in: mlruns/{experiment_id}/models/{model_id}/artifacts/
+            model_path = find_first_artifact(_TRACKING_PATH)
+            
+            if model_path:
+                # Use the first found model directory (direct path works in containers)
+                print(f"  Loading model from: {model_path}")
+                loaded = mlflow.sklearn.load_model(model_path)
+                write_resolved_model(model_path, best_model.version, stage)
+            else:
+                # Fallback: try models:/ URI
+                try:
+                    if _HAS_MODEL_STAGE:
+                        model_uri = f"models:/{MODEL_NAME}/{MODEL_STAGE}"
+                    else:
+                        model_uri = f"models:/{MODEL_NAME}/{best_model.version}"
+                    loaded = mlflow.sklearn.load_model(model_uri)
+                except Exception as e:
+                    raise ValueError(f"Could not load model: {e}")
+            version = f"{best_model.version} (Stage: {stage})"
         
-        best_model = model_versions[0]
+        names = None
+        if hasattr(loaded, 'feature_names_in_'):
+            names = list(loaded.feature_names_in_)
+        elif hasattr(loaded, 'n_features_in_'):
+            names = [f"feature_{i}" for i in range(loaded.n_features_in_)]
         
-        # Try to load model - handle Windows path issues in containers
-        # Get tracking URI base path
-        tracking_uri = MLFLOW_TRACKING_URI.replace('file:', '').replace('file://', '')
-        if not os.path.isabs(tracking_uri):
-            tracking_uri = os.path.join(os.getcwd(), tracking_uri)
+        # Predict straight from ndarray rows instead of building a DataFrame per
+        # request; dropping the fitted names stops sklearn from warning about
+        # (and validating) the missing column labels
+        index = {name: i for i, name in enumerate(names)}
+        if hasattr(loaded, 'feature_names_in_'):
+            loaded.feature_names_in_ = None
         
-        # Find model artifact directory directly (avoids Windows path issues)
-        # Model registry stores models in: mlruns/{experiment_id}/models/{model_id}/artifacts/
-        model_pattern = os.path.join(tracking_uri, '*', 'models', '*', 'artifacts')
-        model_dirs = glob.glob(model_pattern)
+        # Training uses n_jobs=-1; for serving, a joblib pool per predict call is
+        # pure overhead and competes with the executor and uvicorn workers
+        if hasattr(loaded, 'n_jobs'):
+            loaded.n_jobs = 1
         
-        if model_dirs:
-            # Use the first found model directory (direct path works in containers)
-            model_path = model_dirs[0]
-            print(f"  Loading model from: {model_path}")
-            model = mlflow.sklearn.load_model(model_path)
-            model_version = f"{best_model.version} (Stage: {best_model.current_stage if hasattr(best_model, 'current_stage') else MODEL_STAGE})"
+        forest = pack_forest(loaded)
+        if forest is not None:
+            print(f"  Packed {len(forest[0])} trees into float32 SoA arrays for Numba inference")
+            session, session_output = None, None
         else:
-            # Fallback: try models:/ URI
-            try:
-                if MODEL_STAGE and MODEL_STAGE != 'None':
-                    model_uri = f"models:/{MODEL_NAME}/{MODEL_STAGE}"
-                else:
-                    model_uri = f"models:/{MODEL_NAME}/{best_model.version}"
-                model = mlflow.sklearn.load_model(model_uri)
-                model_version = f"{best_model.version} (Stage: {best_model.current_stage if hasattr(best_model, 'current_stage') else MODEL_STAGE})"
-            except Exception as e:
-                raise ValueError(f"Could not load model: {e}")
+            session, session_output = build_onnx_session(loaded, len(names))
+        leaf_values = leaf_value_tables(loaded) if forest is None and session is None else None
         
-        if hasattr(model, 'feature_names_in_'):
-            feature_names = list(model.feature_names_in_)
-        elif hasattr(model, 'n_features_in_'):
-            feature_names = [f"feature_{i}" for i in range(model.n_features_in_)]
+        # Publish; the shared statistics block is named after model_version
+        feature_names, model_version, FEATURE_INDEX = names, version, index
+        FOREST, SESSION, SESSION_OUTPUT, LEAF_VALUES = forest, session, session_output, leaf_values
         
-        # Load training data statistics for drift detection
-        # Try to get statistics from MLflow run
-        try:
-            run_id = best_model.run_id
-            run = client.get_run(run_id)
-            # Try to load training data statistics if available
-            # For now, initialize with None - will be set from training data if available
-            feature_statistics = None
-            print(f"  Note: Feature statistics for drift detection will be initialized from first predictions")
-        except:
-            feature_statistics = None
+        # Feature statistics for drift detection are accumulated from predictions
+        # In production, these should be loaded from training data
+        print(f"  Note: Feature statistics for drift detection will be initialized from first predictions")
+        init_feature_statistics(feature_names)
+        _prediction_cache.clear()
+        model = loaded
         
         print(f"✓ Model loaded successfully. Version: {model_version}. Features: {len(feature_names) if feature_names else 'unknown'}")
         
@@ -146,16 +355,261 @@ def load_model():
         model = None
         feature_names = None
         model_version = "N/A"
-        feature_statistics = None
+        init_feature_statistics(None)
+        FEATURE_INDEX = None
+        SESSION = None
+        SESSION_OUTPUT = None
+        FOREST = None
+        LEAF_VALUES = None
 
 
-@app.on_event("startup")
-async def startup():
-    """Load model on startup"""
+async def _run_batch(items: list):
+    """Predict a batch of queued rows in the executor and resolve their futures"""
+    rows = np.vstack([row for row, _ in items])
     try:
-        load_model()
+        predictions = await asyncio.get_running_loop().run_in_executor(_EXECUTOR, predict_rows, rows)
     except Exception as e:
-        print(f"Warning: Could not load model: {e}")
+        for _, future in items:
+            if not future.done():
+                future.set_exception(e)
+        return
+    
+    for (_, future), prediction in zip(items, predictions):
+        # A future is already done if its request was cancelled meanwhile
+        if not future.done():
+            future.set_result(float(prediction))
+
+
+async def _batch_worker():
+    """Coalesce rows arriving within BATCH_WINDOW_SECONDS into one predict_rows call"""
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await _BATCH_QUEUE.get()]
+        deadline = loop.time() + BATCH_WINDOW_SECONDS
+        while len(items) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(_BATCH_QUEUE.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        # Dispatch without awaiting so the next window fills while this batch runs
+        task = loop.create_task(_run_batch(items))
+        _batch_tasks.add(task)
+        task.add_done_callback(_batch_tasks.discard)
+
+
+def is_forest_regressor(sklearn_model) -> bool:
+    """Whether the model is a single-output random/extra-trees regressor"""
+    from sklearn.ensemble import ExtraTreesRegressor, RandomForestRegressor
+    
+    return (isinstance(sklearn_model, (ExtraTreesRegressor, RandomForestRegressor))
+            and sklearn_model.n_outputs_ == 1)
+
+
+def pack_forest(sklearn_model) -> Optional[tuple]:
+    """
+    Pack a fitted single-output forest regressor into contiguous structure-of-arrays
+    form (int32 indices, float32 thresholds/leaf values) for _forest_predict.
+    
+    sklearn's Tree refuses node arrays that are not float64, so the trees cannot be
+    downcast in place; the packed copy is what halves the bytes walked per node.
+    
+    Returns:
+        tuple: (roots, feature, threshold, left, right, value), or None if unsupported
+    """
+    if njit is None or not is_forest_regressor(sklearn_model):
+        return None
+    
+    trees = [est.tree_ for est in sklearn_model.estimators_]
+    offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+    roots = offsets[:-1].astype(np.int32)
+    
+    feature = np.concatenate([tree.feature for tree in trees]).astype(np.int32)
+    value = np.concatenate([tree.value[:, 0, 0] for tree in trees]).astype(np.float32)
+    left = np.concatenate([
+        np.where(tree.children_left == -1, -1, tree.children_left + offset)
+        for tree, offset in zip(trees, roots)
+    ]).astype(np.int32)
+    right = np.concatenate([
+        np.where(tree.children_right == -1, -1, tree.children_right + offset)
+        for tree, offset in zip(trees, roots)
+    ]).astype(np.int32)
+    
+    # Round thresholds down to float32 so that, for the float32 inputs sklearn also
+    # uses, x <= t32 holds exactly when x <= t64 does
+    threshold64 = np.concatenate([tree.threshold for tree in trees])
+    threshold = threshold64.astype(np.float32)
+    rounded_up = threshold.astype(np.float64) > threshold64
+    threshold[rounded_up] = np.nextafter(threshold[rounded_up], np.float32(-np.inf))
+    
+    return roots, feature, threshold, left, right, value
+
+
+def _forest_predict(X, roots, feature, threshold, left, right, value):
+    """Average the leaf values reached by each row of X across all packed trees"""
+    n_trees = roots.shape[0]
+    n_rows = X.shape[0]
+    out = np.empty(n_rows)
+    
+    if n_rows >= FOREST_ROW_PARALLEL_MIN:
+        # Enough rows to keep every thread busy: walk rows in parallel, each
+        # summing its trees in order, so memory stays O(rows)
+        for r in prange(n_rows):
+            total = 0.0
+            for t in range(n_trees):
+                node = roots[t]
+                while left[node] != -1:
+                    if X[r, feature[node]] <= threshold[node]:
+                        node = left[node]
+                    else:
+                        node = right[node]
+                total += value[node]
+            out[r] = total / n_trees
+        return out
+    
+    # Few rows (single /predict requests): walk trees in parallel instead, each
+    # writing its own row of leaf values; at most n_trees * FOREST_ROW_PARALLEL_MIN
+    leaves = np.empty((n_trees, n_rows))
+    for t in prange(n_trees):
+        for r in range(n_rows):
+            node = roots[t]
+            while left[node] != -1:
+                if X[r, feature[node]] <= threshold[node]:
+                    node = left[node]
+                else:
+                    node = right[node]
+            leaves[t, r] = value[node]
+    
+    for r in range(n_rows):
+        total = 0.0
+        for t in range(n_trees):
+            total += leaves[t, r]
+        out[r] = total / n_trees
+    return out
+
+
+if njit is not None:
+    _forest_predict = njit(cache=True, nogil=True, parallel=True)(_forest_predict)
+
+# Replaced by a real lock in warm_jit_kernels only if Numba picked the workqueue
+# threading layer, which (unlike TBB/OpenMP) cannot run parallel kernels
+# launched from several executor threads at once
+_FOREST_LOCK = nullcontext()
+
+
+def leaf_value_tables(sklearn_model) -> Optional[list]:
+    """
+    Collect (tree, leaf values) pairs so a forest regressor prediction becomes a
+    leaf lookup per tree, skipping predict's joblib dispatch and output buffers.
+    
+    Returns:
+        list of (Tree, values) pairs, or None if the model is not supported
+    """
+    if not is_forest_regressor(sklearn_model):
+        return None
+    return [(est.tree_, est.tree_.value[:, 0, 0].copy()) for est in sklearn_model.estimators_]
+
+
+def build_onnx_session(sklearn_model, n_features: int) -> tuple:
+    """
+    Convert the sklearn model to ONNX and compile it into an ONNX Runtime session.
+    
+    Returns:
+        tuple: (session, output_name), or (None, None) to fall back to sklearn
+    """
+    try:
+        from skl2onnx import convert_sklearn
+        from skl2onnx.common.data_types import FloatTensorType
+    except ImportError:
+        convert_sklearn = None
+    
+    if ort is None or convert_sklearn is None:
+        print("  Note: skl2onnx/onnxruntime not installed, serving with sklearn")
+        return None, None
+    
+    try:
+        onx = convert_sklearn(
+            sklearn_model,
+            initial_types=[('X', FloatTensorType([None, n_features]))],
+            options={id(sklearn_model): {'zipmap': False}}
+        )
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = 1
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = ort.InferenceSession(
+            onx.SerializeToString(), sess_options, providers=['CPUExecutionProvider']
+        )
+        print("  Compiled model to ONNX Runtime")
+        return session, session.get_outputs()[0].name
+    except Exception as e:
+        print(f"  Note: ONNX conversion failed ({e}), serving with sklearn")
+        return None, None
+
+
+def predict_rows(rows: np.ndarray) -> np.ndarray:
+    """Predict a (n_rows, n_features) float32 array with the fastest available backend"""
+    if FOREST is not None:
+        with _FOREST_LOCK:
+            return _forest_predict(rows, *FOREST)
+    if SESSION is not None:
+        return SESSION.run([SESSION_OUTPUT], {'X': rows})[0].ravel()
+    if LEAF_VALUES is not None:
+        return np.mean([values[tree.apply(rows)] for tree, values in LEAF_VALUES], axis=0)
+    return model.predict(rows)
+
+
+async def ensure_model_loaded():
+    """Load the model on first use; concurrent first requests share a single load"""
+    global _load_attempted
+    
+    if model is not None or _load_attempted:
+        return
+    async with _LOAD_LOCK:
+        if model is None and not _load_attempted:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, load_model)
+            except Exception as e:
+                print(f"Warning: Could not load model: {e}")
+            _load_attempted = True
+
+
+@app.on_event("startup")
+async def startup():
+    """Start the micro-batcher; the model itself is loaded lazily by /predict"""
+    global _BATCH_QUEUE, _batch_worker_task
+    
+    _BATCH_QUEUE = asyncio.Queue()
+    _batch_worker_task = asyncio.create_task(_batch_worker())
+    if feature_names and _count is None:
+        # Restarted after a shutdown released the statistics
+        init_feature_statistics(feature_names)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Stop the micro-batcher, publish pending feature statistics and detach from them"""
+    global _BATCH_QUEUE, _batch_worker_task
+    
+    if _batch_worker_task is not None:
+        _batch_worker_task.cancel()
+    _BATCH_QUEUE = None
+    _batch_worker_task = None
+    flush_feature_statistics()
+    release_feature_statistics()
+
+
+def current_timestamp() -> str:
+    """UTC ISO timestamp shared by all responses within the same millisecond"""
+    global CURRENT_TS, _ts_refreshed
+    
+    now = time.monotonic()
+    if now - _ts_refreshed >= 0.001:
+        CURRENT_TS = datetime.utcnow().isoformat()
+        _ts_refreshed = now
+    return CURRENT_TS
 
 
 @app.get("/")
@@ -169,132 +623,448 @@ async def root():
 
 @app.get("/health")
 async def health():
+    if model is None and not _load_attempted:
+        # Ready for traffic; the first /predict loads the model
+        return {
+            "status": "warming",
+            "warming": True,
+            "timestamp": current_timestamp(),
+            "model_version": model_version
+        }
     if model is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     return {
         "status": "healthy",
-        "timestamp": datetime.utcnow().isoformat(),
+        "warming": False,
+        "timestamp": current_timestamp(),
         "model_version": model_version
     }
 
 
-def detect_data_drift(features_dict: Dict[str, float]) -> tuple:
+def _open_locked(path: str):
     """
-    Detect data drift by checking if feature values are out-of-distribution.
-    Uses simple statistical method: values outside 3 standard deviations are considered drift.
+    Open and exclusively flock the lock file at path. The last worker to detach
+    removes the file, so retry if the file locked is no longer the one at path.
+    """
+    while True:
+        lock_file = open(path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.fstat(lock_file.fileno()).st_ino == os.stat(path).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            lock_file.close()
+            raise
+        lock_file.close()
+
+
+def _attach_shared_statistics(names: list) -> Optional[SharedMemory]:
+    """
+    Create, or attach to, the shared memory block holding count/mean/m2 for
+    these features. The block is named after the tracking store, model name,
+    model version and features, so a retrained model (or another deployment
+    on the same host) starts from fresh statistics.
+    
+    The first int64 of the block counts the attached workers; the last worker
+    to detach unlinks it and removes its <name>.lock file in the temp dir (see
+    release_feature_statistics). A worker killed without a clean shutdown
+    leaves both behind; to reset the statistics, stop the server and remove
+    /dev/shm/<FEATURE_STATS_SHM>_* and <tempdir>/<FEATURE_STATS_SHM>_*.lock.
     
     Returns:
-        tuple: (drift_detected: bool, drift_features: list, drift_ratio: float)
+        SharedMemory, or None when sharing is disabled or unavailable
     """
-    global feature_statistics
+    global _stats_lock_file
     
-    if not feature_names or not feature_statistics:
-        # Initialize statistics from first few predictions (simple approach)
-        # In production, this should be loaded from training data
-        return False, [], 0.0
+    if not FEATURE_STATS_SHM or fcntl is None:
+        return None
     
-    drift_features = []
-    total_features = len(feature_names)
+    key = '|'.join([_TRACKING_PATH, MODEL_NAME, model_version] + list(names))
+    name = f"{FEATURE_STATS_SHM}_{hashlib.sha1(key.encode()).hexdigest()[:8]}"
+    size = (3 * len(names) + 1) * 8
+    lock_file = None
+    try:
+        lock_file = _open_locked(os.path.join(tempfile.gettempdir(), f"{name}.lock"))
+        try:
+            try:
+                shm = SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                shm = SharedMemory(name=name)
+            if shm.size < size:
+                shm.close()
+                raise ValueError(f"shared memory block {name} is too small")
+            # Unlinking is managed by the attach count, not by this process's
+            # resource tracker (which would unlink on exit while others use it)
+            resource_tracker.unregister(shm._name, 'shared_memory')
+            np.ndarray((1,), dtype=np.int64, buffer=shm.buf)[0] += 1
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    except (OSError, ValueError) as e:
+        if lock_file is not None:
+            lock_file.close()
+        print(f"  Note: Could not share feature statistics across workers ({e}), using per-worker statistics")
+        return None
     
-    for feature_name in feature_names:
-        if feature_name not in features_dict:
-            continue
-            
-        value = features_dict[feature_name]
-        
-        if feature_name in feature_statistics:
-            mean = feature_statistics[feature_name].get('mean', 0)
-            std = feature_statistics[feature_name].get('std', 1)
-            
-            # Check if value is outside 3 standard deviations
-            if std > 0 and abs(value - mean) > 3 * std:
-                drift_features.append(feature_name)
-                DATA_DRIFT_DETECTIONS.labels(feature=feature_name).inc()
+    _stats_lock_file = lock_file
+    print(f"  Feature statistics shared across workers via shared memory: {name}")
+    return shm
+
+
+def release_feature_statistics():
+    """Detach from the shared statistics block, removing it and its lock file if this was the last worker"""
+    global _count, _mean, _m2, _stats_shm, _stats_lock_file
     
-    drift_ratio = len(drift_features) / total_features if total_features > 0 else 0.0
-    return len(drift_features) > 0, drift_features, drift_ratio
+    shm, lock_file = _stats_shm, _stats_lock_file
+    if shm is None:
+        return
+    _count = _mean = _m2 = None
+    _stats_shm = _stats_lock_file = None
+    
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+        attached = np.ndarray((1,), dtype=np.int64, buffer=shm.buf)
+        attached[0] -= 1
+        last = attached[0] <= 0
+        del attached
+        try:
+            shm.close()
+        except BufferError:
+            pass
+        if last:
+            try:
+                # unlink() also unregisters from the resource tracker
+                resource_tracker.register(shm._name, 'shared_memory')
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+            try:
+                os.remove(lock_file.name)
+            except FileNotFoundError:
+                pass
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
 
 
-def update_feature_statistics(features_dict: Dict[str, float]):
-    """Update running statistics for features (simple moving average approach)"""
-    global feature_statistics
+def init_feature_statistics(names: Optional[list]):
+    """Reset the running statistics arrays (and drift counters) for the given features"""
+    global _count, _mean, _m2, _pending_count, _pending_mean, _pending_m2, _pending_rows
+    global _drift_mask, _stats_shm, DRIFT_CHILDREN
     
-    if not feature_names:
+    release_feature_statistics()
+    _count = _mean = _m2 = _pending_count = _pending_mean = _pending_m2 = None
+    _drift_mask = DRIFT_CHILDREN = None
+    _pending_rows = 0
+    
+    if not names:
         return
     
-    if feature_statistics is None:
-        feature_statistics = {}
-        for feat in feature_names:
-            feature_statistics[feat] = {'mean': 0.0, 'std': 1.0, 'count': 0, 'sum': 0.0, 'sum_sq': 0.0}
+    n = len(names)
+    _stats_shm = _attach_shared_statistics(names)
+    if _stats_shm is not None:
+        # Shared memory is zero-filled on creation, which is the empty state;
+        # the first int64 is the attach count
+        _count = np.ndarray((n,), dtype=np.int64, buffer=_stats_shm.buf, offset=8)
+        _mean = np.ndarray((n,), dtype=np.float64, buffer=_stats_shm.buf, offset=8 + n * 8)
+        _m2 = np.ndarray((n,), dtype=np.float64, buffer=_stats_shm.buf, offset=8 + 2 * n * 8)
+    else:
+        _count = np.zeros(n, dtype=np.int64)
+        _mean = np.zeros(n, dtype=np.float64)
+        _m2 = np.zeros(n, dtype=np.float64)
+    _pending_count = np.zeros(n, dtype=np.int64)
+    _pending_mean = np.zeros(n, dtype=np.float64)
+    _pending_m2 = np.zeros(n, dtype=np.float64)
+    _drift_mask = np.zeros(n, dtype=np.bool_)
+    DRIFT_CHILDREN = [DATA_DRIFT_DETECTIONS.labels(feature=f) for f in names]
+
+
+def flush_feature_statistics():
+    """Merge this worker's pending statistics into the shared ones (Chan et al.)"""
+    global _pending_rows
     
-    # Update statistics using Welford's online algorithm
-    for feat in feature_names:
-        if feat not in features_dict:
-            continue
-            
-        value = features_dict[feat]
-        stats = feature_statistics[feat]
-        stats['count'] += 1
-        n = stats['count']
-        
-        # Update mean
-        delta = value - stats['mean']
-        stats['mean'] += delta / n
-        
-        # Update variance
-        delta2 = value - stats['mean']
-        stats['sum_sq'] += delta * delta2
+    if _pending_rows == 0 or _count is None:
+        return
+    
+    if _stats_shm is not None:
+        fcntl.flock(_stats_lock_file, fcntl.LOCK_EX)
+    try:
+        # Statistics that went non-finite would poison every later drift
+        # check: start those features over, and never merge such pending values
+        corrupt = ~(np.isfinite(_mean) & np.isfinite(_m2))
+        if corrupt.any():
+            _count[corrupt] = 0
+            _mean[corrupt] = 0.0
+            _m2[corrupt] = 0.0
+        ok = (_pending_count > 0) & np.isfinite(_pending_mean) & np.isfinite(_pending_m2)
+        total = _count[ok] + _pending_count[ok]
+        weight = _pending_count[ok] / total
+        cross = _count[ok] * weight
+        delta = _pending_mean[ok] - _mean[ok]
+        _mean[ok] += delta * weight
+        _m2[ok] += _pending_m2[ok] + delta * delta * cross
+        _count[ok] = total
+    finally:
+        if _stats_shm is not None:
+            fcntl.flock(_stats_lock_file, fcntl.LOCK_UN)
+    
+    _pending_count[:] = 0
+    _pending_mean[:] = 0.0
+    _pending_m2[:] = 0.0
+    _pending_rows = 0
+
+
+def _update_and_drift(x, mean, m2, count, p_mean, p_m2, p_count, out_mask):
+    """
+    Fused Welford update of the pending statistics + 3-sigma drift check against
+    the shared ones; fills out_mask, returns drift count
+    """
+    n = x.shape[0]
+    ndrift = 0
+    for i in range(n):
+        p_count[i] += 1
+        d = x[i] - p_mean[i]
+        p_mean[i] += d / p_count[i]
+        p_m2[i] += d * (x[i] - p_mean[i])
         
-        if n > 1:
-            stats['std'] = np.sqrt(stats['sum_sq'] / (n - 1))
+        c = count[i]
+        std = (m2[i] / (c - 1)) ** 0.5 if c > 1 else 0.0
+        if std > 0 and abs(x[i] - mean[i]) > 3 * std:
+            out_mask[i] = True
+            ndrift += 1
         else:
-            stats['std'] = 1.0
+            out_mask[i] = False
+    return ndrift
+
+
+if njit is not None:
+    _update_and_drift = njit(cache=True, fastmath=True)(_update_and_drift)
 
 
-@app.post("/predict", response_model=PredictionResponse)
-async def predict(request: PredictionRequest):
+def warm_jit_kernels():
+    """
+    Compile the Numba kernels for the serving dtypes so no request pays for it.
+    
+    Runs at import, on the main thread: TBB, Numba's preferred threading layer,
+    hangs interpreter exit if its first parallel launch came from another thread
+    (e.g. the executor that loads the model).
+    """
+    global _FOREST_LOCK
+    
+    if njit is None:
+        return
+    
+    _update_and_drift(
+        np.zeros(1, dtype=np.float32), np.zeros(1), np.zeros(1), np.zeros(1, dtype=np.int64),
+        np.zeros(1), np.zeros(1), np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.bool_)
+    )
+    # A one-leaf forest with the dtypes pack_forest produces
+    index = np.array([-1], dtype=np.int32)
+    _forest_predict(
+        np.zeros((1, 1), dtype=np.float32), np.zeros(1, dtype=np.int32), index,
+        np.zeros(1, dtype=np.float32), index, index, np.zeros(1, dtype=np.float32)
+    )
+    # The threading layer is only known after the first parallel launch
+    if threading_layer() == 'workqueue':
+        _FOREST_LOCK = threading.Lock()
+
+
+warm_jit_kernels()
+
+
+def update_feature_statistics(x: np.ndarray):
+    """Update pending statistics with one input row using Welford's online algorithm"""
+    global _pending_count, _pending_mean, _pending_m2
+    
+    _pending_count += 1
+    delta = x - _pending_mean
+    _pending_mean += delta / _pending_count
+    _pending_m2 += delta * (x - _pending_mean)
+
+
+def detect_data_drift(x: np.ndarray) -> tuple:
+    """
+    Update feature statistics with one input row and detect data drift by checking
+    if feature values are out-of-distribution for the statistics shared by all workers.
+    Uses simple statistical method: values outside 3 standard deviations are considered drift.
+    
+    Returns:
+        tuple: (drift_detected: bool, drift_features: list, drift_ratio: float)
+    """
+    global _pending_rows
+    
+    if _count is None:
+        return False, [], 0.0
+    
+    if njit is not None:
+        _update_and_drift(x, _mean, _m2, _count, _pending_mean, _pending_m2, _pending_count, _drift_mask)
+        drift_mask = _drift_mask
+    else:
+        update_feature_statistics(x)
+        std = np.sqrt(_m2 / np.maximum(_count - 1, 1))
+        drift_mask = (_count > 1) & (std > 0) & (np.abs(x - _mean) > 3 * std)
+    
+    _pending_rows += 1
+    if _pending_rows >= STATS_FLUSH_INTERVAL:
+        flush_feature_statistics()
+    
+    drift_idx = np.flatnonzero(drift_mask)
+    for i in drift_idx:
+        DRIFT_CHILDREN[i].inc()
+    
+    drift_features = [feature_names[i] for i in drift_idx]
+    return len(drift_features) > 0, drift_features, float(drift_mask.mean())
+
+
+def fill_row(row: np.ndarray, feats: dict):
+    """Fill one input row from a feature mapping in model feature order"""
+    try:
+        for name, i in FEATURE_INDEX.items():
+            row[i] = feats[name]
+    except KeyError:
+        # Only a failed request pays for working out which features are absent
+        missing = [f for f in feature_names if f not in feats]
+        raise HTTPException(status_code=400, detail=f"Missing features: {missing}")
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Features must be a mapping of name to number")
+    
+    # Values beyond float32 range (or NaN/inf) would otherwise reach the model
+    # and the drift statistics as inf
+    if not np.isfinite(row).all():
+        raise HTTPException(status_code=400, detail="Feature values must be finite and within float32 range")
+
+
+@app.post(
+    "/predict",
+    response_model=PredictionResponse,
+    # The body is parsed with orjson below; document the schema it expects
+    openapi_extra={"requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": PredictionRequest.model_json_schema()}}
+    }}
+)
+async def predict(request: Request):
     """Make temperature prediction"""
-    start = time.time()
+    start = time.perf_counter()
     
+    await ensure_model_loaded()
     if model is None:
-        REQUEST_COUNT.labels(status='error').inc()
+        REQ_ERR.inc()
         raise HTTPException(status_code=503, detail="Model not loaded")
     
     try:
-        # Convert to DataFrame
-        features_df = pd.DataFrame([request.features])
-        
-        # Check features
-        if feature_names:
-            missing = set(feature_names) - set(features_df.columns)
-            if missing:
-                raise HTTPException(status_code=400, detail=f"Missing features: {list(missing)}")
-            features_df = features_df[feature_names]
+        # The float32 row fill below is the only per-feature validation needed,
+        # so the body skips Pydantic and is parsed straight with orjson.
+        try:
+            feats = orjson.loads(await request.body())['features']
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            raise HTTPException(status_code=400, detail="Body must be a JSON object with a 'features' mapping")
         
-        # Update feature statistics for drift detection
-        update_feature_statistics(request.features)
+        # This request's own row: other requests run while this one awaits the batch
+        row = np.empty(len(FEATURE_INDEX), dtype=np.float32)
+        fill_row(row, feats)
         
-        # Detect data drift
-        drift_detected, drift_features, drift_ratio = detect_data_drift(request.features)
+        # Update feature statistics and detect data drift
+        drift_detected, drift_features, drift_ratio = detect_data_drift(row)
         DRIFT_RATIO.observe(drift_ratio)
         
-        # Predict
-        prediction = model.predict(features_df)[0]
+        # Repeated feature vectors are served from the cache, keyed on the row
+        # rounded to 4 decimals; the model itself always scores the raw row
+        prediction = key = None
+        if PREDICTION_CACHE_SIZE > 0:
+            key = row.round(4).tobytes()
+            prediction = _prediction_cache.get(key)
+            if prediction is not None:
+                _prediction_cache.move_to_end(key)
+        if prediction is None:
+            if _BATCH_QUEUE is not None:
+                future = asyncio.get_running_loop().create_future()
+                _BATCH_QUEUE.put_nowait((row, future))
+                prediction = await future
+            else:
+                # Batch worker not running (startup hook skipped): predict directly
+                prediction = (await asyncio.get_running_loop().run_in_executor(
+                    _EXECUTOR, predict_rows, row.reshape(1, -1)
+                ))[0]
+            
+            if key is not None:
+                _prediction_cache[key] = prediction
+                if len(_prediction_cache) > PREDICTION_CACHE_SIZE:
+                    _prediction_cache.popitem(last=False)
         
         # Metrics
-        latency = time.time() - start
-        INFERENCE_LATENCY.observe(latency)
-        REQUEST_COUNT.labels(status='success').inc()
+        INFERENCE_LATENCY.observe(time.perf_counter() - start)
+        REQ_OK.inc()
         
-        return PredictionResponse(
-            prediction=float(prediction),
-            timestamp=datetime.utcnow().isoformat(),
-            model_version=model_version
-        )
+        # Returning the response directly skips response_model re-validation
+        return ORJSONResponse({
+            "prediction": float(prediction),
+            "timestamp": current_timestamp(),
+            "model_version": model_version
+        })
+    except HTTPException:
+        raise
+    except Exception as e:
+        REQ_ERR.inc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post(
+    "/predict_batch",
+    response_model=BatchPredictionResponse,
+    openapi_extra={"requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": BatchPredictionRequest.model_json_schema()}}
+    }}
+)
+async def predict_batch(request: Request):
+    """
+    Make temperature predictions for many rows with a single model pass.
+    Intended for offline scoring, so rows bypass the prediction cache and
+    do not feed the drift statistics.
+    """
+    start = time.perf_counter()
+    
+    await ensure_model_loaded()
+    if model is None:
+        BATCH_REQ_ERR.inc()
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    
+    try:
+        try:
+            rows = orjson.loads(await request.body())['features']
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            raise HTTPException(status_code=400, detail="Body must be a JSON object with a 'features' list")
+        if not isinstance(rows, list) or not rows:
+            raise HTTPException(status_code=400, detail="'features' must be a non-empty list of mappings")
+        if len(rows) > PREDICT_BATCH_MAX_ROWS:
+            raise HTTPException(
+                status_code=413, detail=f"At most {PREDICT_BATCH_MAX_ROWS} rows per request, got {len(rows)}"
+            )
+        
+        X = np.empty((len(rows), len(FEATURE_INDEX)), dtype=np.float32)
+        for r, feats in enumerate(rows):
+            try:
+                fill_row(X[r], feats)
+            except HTTPException as e:
+                raise HTTPException(status_code=e.status_code, detail=f"Row {r}: {e.detail}")
+        
+        predictions = await asyncio.get_running_loop().run_in_executor(_EXECUTOR, predict_rows, X)
+        
+        # Metrics
+        BATCH_LATENCY.observe(time.perf_counter() - start)
+        BATCH_REQ_OK.inc()
+        
+        return ORJSONResponse({
+            "predictions": predictions.tolist(),
+            "timestamp": current_timestamp(),
+            "model_version": model_version
+        })
     except HTTPException:
         raise
     except Exception as e:
-        REQUEST_COUNT.labels(status='error').inc()
+        BATCH_REQ_ERR.inc()
         raise HTTPException(status_code=500, detail=str(e))
 
 
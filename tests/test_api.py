@@ -2,14 +2,20 @@
 Unit tests for FastAPI prediction server
 """
 
+import os
 import pytest
 from fastapi.testclient import TestClient
 import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 from pathlib import Path
 
 PROJECT_ROOT = Path(__file__).parent.parent
 sys.path.append(str(PROJECT_ROOT))
 
+import api.prediction_server as prediction_server
 from api.prediction_server import app
 
 
@@ -25,8 +31,17 @@ def test_root_endpoint(client):
     assert "service" in response.json()
 
 
-def test_health_check_no_model(client):
-    """Test health check when model is not loaded"""
+def test_health_check_warming(client, monkeypatch):
+    """Test health check before the first prediction has loaded the model"""
+    monkeypatch.setattr(prediction_server, "_load_attempted", False)
+    response = client.get("/health")
+    assert response.status_code == 200
+    assert response.json()["warming"] is True
+
+
+def test_health_check_no_model(client, monkeypatch):
+    """Test health check when model loading failed"""
+    monkeypatch.setattr(prediction_server, "_load_attempted", True)
     response = client.get("/health")
     assert response.status_code == 503
 
@@ -36,3 +51,277 @@ def test_metrics_endpoint(client):
     response = client.get("/metrics")
     assert response.status_code == 200
 
+
+def test_resolved_model_sidecar(tmp_path, monkeypatch):
+    """Test that the cached model resolution is reused until the model or config changes"""
+    monkeypatch.setattr(prediction_server, "MODEL_NAME", "predictor")
+    monkeypatch.setattr(prediction_server, "MODEL_STAGE", "Production")
+    artifacts = tmp_path / "1" / "models" / "m-1" / "artifacts"
+    artifacts.mkdir(parents=True)
+    registry = tmp_path / "models" / "predictor"
+    registry.mkdir(parents=True)
+    monkeypatch.setattr(prediction_server, "_RESOLVED_MODEL_PATH", str(tmp_path / ".resolved_model.json"))
+    monkeypatch.setattr(prediction_server, "_REGISTRY_DIR", str(registry))
+    
+    assert prediction_server.read_resolved_model() is None
+    
+    def bump_mtime(path):
+        mtime = os.path.getmtime(path) + 10
+        os.utime(path, (mtime, mtime))
+    
+    prediction_server.write_resolved_model(str(artifacts), 3, "Production")
+    resolved = prediction_server.read_resolved_model()
+    assert (resolved["model_path"], resolved["version"], resolved["stage"]) == (str(artifacts), "3", "Production")
+    
+    # The artifacts changed
+    bump_mtime(artifacts)
+    assert prediction_server.read_resolved_model() is None
+    
+    # A new version was registered
+    prediction_server.write_resolved_model(str(artifacts), 3, "Production")
+    bump_mtime(registry)
+    assert prediction_server.read_resolved_model() is None
+    
+    # The server now asks for another stage or model
+    prediction_server.write_resolved_model(str(artifacts), 3, "Production")
+    monkeypatch.setattr(prediction_server, "MODEL_STAGE", "Staging")
+    assert prediction_server.read_resolved_model() is None
+    monkeypatch.setattr(prediction_server, "MODEL_STAGE", "Production")
+    assert prediction_server.read_resolved_model() is not None
+    monkeypatch.setattr(prediction_server, "MODEL_NAME", "other_predictor")
+    assert prediction_server.read_resolved_model() is None
+
+
+def test_predict_missing_features(client, monkeypatch):
+    """Test that missing features are reported in model feature order"""
+    monkeypatch.setattr(prediction_server, "model", object())
+    monkeypatch.setattr(prediction_server, "feature_names", ["temp", "humidity", "wind"])
+    monkeypatch.setattr(prediction_server, "FEATURE_INDEX", {"temp": 0, "humidity": 1, "wind": 2})
+    
+    response = client.post("/predict", json={"features": {"humidity": 40.0}})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Missing features: ['temp', 'wind']"
+
+
+def test_predict_rejects_out_of_range_values(client, monkeypatch):
+    """Test that values overflowing float32 are rejected instead of predicted as inf"""
+    monkeypatch.setattr(prediction_server, "model", object())
+    monkeypatch.setattr(prediction_server, "feature_names", ["temp", "humidity"])
+    monkeypatch.setattr(prediction_server, "FEATURE_INDEX", {"temp": 0, "humidity": 1})
+    
+    response = client.post("/predict", json={"features": {"temp": 1e39, "humidity": 40.0}})
+    assert response.status_code == 400
+    
+    rows = [{"temp": 30.0, "humidity": 40.0}, {"temp": 30.0, "humidity": -1e39}]
+    response = client.post("/predict_batch", json={"features": rows})
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("Row 1:")
+
+
+def test_predict_batch_reports_row(client, monkeypatch):
+    """Test that batch validation errors name the offending row"""
+    monkeypatch.setattr(prediction_server, "model", object())
+    monkeypatch.setattr(prediction_server, "feature_names", ["temp", "humidity"])
+    monkeypatch.setattr(prediction_server, "FEATURE_INDEX", {"temp": 0, "humidity": 1})
+    
+    rows = [{"temp": 30.0, "humidity": 40.0}, {"temp": 31.0}]
+    response = client.post("/predict_batch", json={"features": rows})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Row 1: Missing features: ['humidity']"
+
+
+def test_predict_scores_raw_row_without_cache(client, monkeypatch):
+    """Test that /predict scores the request's own values, not the rounded cache key"""
+    from sklearn.tree import DecisionTreeRegressor
+    
+    # Single split at 0.00012: 0.00013 lies right of it, its 4-decimal rounding left
+    tree = DecisionTreeRegressor(max_depth=1).fit([[0.0], [0.00024]], [0.0, 1.0])
+    monkeypatch.setattr(prediction_server, "model", tree)
+    monkeypatch.setattr(prediction_server, "feature_names", ["temp"])
+    monkeypatch.setattr(prediction_server, "FEATURE_INDEX", {"temp": 0})
+    monkeypatch.setattr(prediction_server, "PREDICTION_CACHE_SIZE", 0)
+    
+    raw = np.array([[0.00013]], dtype=np.float32)
+    assert prediction_server.predict_rows(raw)[0] != prediction_server.predict_rows(raw.round(4))[0]
+    
+    response = client.post("/predict", json={"features": {"temp": 0.00013}})
+    assert response.status_code == 200
+    assert response.json()["prediction"] == prediction_server.predict_rows(raw)[0]
+
+
+def test_predict_cache_hits_and_evicts(client, monkeypatch):
+    """Test that the prediction cache serves repeats and evicts least recently used rows"""
+    monkeypatch.setattr(prediction_server, "model", object())
+    monkeypatch.setattr(prediction_server, "feature_names", ["temp"])
+    monkeypatch.setattr(prediction_server, "FEATURE_INDEX", {"temp": 0})
+    monkeypatch.setattr(prediction_server, "PREDICTION_CACHE_SIZE", 2)
+    monkeypatch.setattr(prediction_server, "_prediction_cache", OrderedDict())
+    
+    scored = []
+    
+    def predict_rows(rows):
+        scored.append(float(rows[0, 0]))
+        return rows[:, 0] * 2
+    
+    monkeypatch.setattr(prediction_server, "predict_rows", predict_rows)
+    
+    def predict(temp):
+        response = client.post("/predict", json={"features": {"temp": temp}})
+        assert response.status_code == 200
+        return response.json()["prediction"]
+    
+    assert predict(1.0) == 2.0
+    assert predict(2.0) == 4.0
+    # Same 4-decimal key as 1.0: served from the cache
+    assert predict(1.00001) == 2.0
+    # Evicts 2.0, the least recently used entry
+    assert predict(3.0) == 6.0
+    assert predict(1.0) == 2.0
+    assert predict(2.0) == 4.0
+    assert scored == [1.0, 2.0, 3.0, 2.0]
+
+
+def test_predict_batch_row_limit(client, monkeypatch):
+    """Test that /predict_batch rejects requests over PREDICT_BATCH_MAX_ROWS"""
+    monkeypatch.setattr(prediction_server, "model", object())
+    monkeypatch.setattr(prediction_server, "feature_names", ["temp"])
+    monkeypatch.setattr(prediction_server, "FEATURE_INDEX", {"temp": 0})
+    monkeypatch.setattr(prediction_server, "PREDICT_BATCH_MAX_ROWS", 2)
+    
+    response = client.post("/predict_batch", json={"features": [{"temp": 1.0}] * 3})
+    assert response.status_code == 413
+
+
+def test_predict_concurrent_requests_get_own_result(monkeypatch):
+    """Test that coalesced /predict requests each get their own row's prediction"""
+    monkeypatch.setattr(prediction_server, "model", object())
+    monkeypatch.setattr(prediction_server, "feature_names", ["temp", "humidity"])
+    monkeypatch.setattr(prediction_server, "FEATURE_INDEX", {"temp": 0, "humidity": 1})
+    monkeypatch.setattr(prediction_server, "PREDICTION_CACHE_SIZE", 0)
+    monkeypatch.setattr(prediction_server, "BATCH_WINDOW_SECONDS", 0.05)
+    
+    batch_sizes = []
+    
+    def predict_rows(rows):
+        batch_sizes.append(len(rows))
+        return rows.sum(axis=1)
+    
+    monkeypatch.setattr(prediction_server, "predict_rows", predict_rows)
+    
+    def post(i):
+        response = client.post("/predict", json={"features": {"temp": float(i), "humidity": 1000.0 * i}})
+        return i, response
+    
+    with TestClient(app) as client:
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            results = list(pool.map(post, range(200)))
+    
+    for i, response in results:
+        assert response.status_code == 200
+        assert response.json()["prediction"] == 1001.0 * i
+    assert sum(batch_sizes) == 200
+    assert max(batch_sizes) > 1
+
+
+def test_concurrent_first_requests_wait_for_full_load(monkeypatch):
+    """Test that requests arriving during a slow model load only run once it is complete"""
+    import asyncio
+    import time
+    import mlflow.sklearn
+    from sklearn.ensemble import RandomForestRegressor
+    
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(200, 3)).astype(np.float32)
+    forest = RandomForestRegressor(n_estimators=5, random_state=0).fit(X, X.sum(axis=1))
+    
+    for name in ("model", "feature_names", "model_version", "FEATURE_INDEX", "FOREST",
+                 "SESSION", "SESSION_OUTPUT", "LEAF_VALUES", "_load_attempted"):
+        monkeypatch.setattr(prediction_server, name, getattr(prediction_server, name))
+    monkeypatch.setattr(prediction_server, "_LOAD_LOCK", asyncio.Lock())
+    monkeypatch.setattr(prediction_server, "FEATURE_STATS_SHM", "")
+    monkeypatch.setattr(prediction_server, "PREDICTION_CACHE_SIZE", 0)
+    monkeypatch.setattr(prediction_server, "read_resolved_model",
+                        lambda: {"model_path": "unused", "version": "1", "stage": "Production"})
+    monkeypatch.setattr(mlflow.sklearn, "load_model", lambda path: forest)
+    
+    pack_forest = prediction_server.pack_forest
+    
+    def slow_pack_forest(sklearn_model):
+        time.sleep(0.5)
+        return pack_forest(sklearn_model)
+    
+    monkeypatch.setattr(prediction_server, "pack_forest", slow_pack_forest)
+    
+    def post(i):
+        time.sleep(0.01 * i)
+        features = {f"feature_{j}": float(X[i, j]) for j in range(3)}
+        return client.post("/predict", json={"features": features})
+    
+    try:
+        with TestClient(app) as client:
+            with ThreadPoolExecutor(max_workers=20) as pool:
+                responses = list(pool.map(post, range(20)))
+            seen = prediction_server._count + prediction_server._pending_count
+        
+        assert [r.status_code for r in responses] == [200] * 20
+        np.testing.assert_allclose([r.json()["prediction"] for r in responses], forest.predict(X[:20]), rtol=1e-5)
+        # Every request went through drift detection
+        assert (seen == 20).all()
+    finally:
+        prediction_server.init_feature_statistics(None)
+
+
+def test_packed_forest_matches_sklearn(monkeypatch):
+    """Test the packed float32 forest against sklearn, including inputs on split thresholds"""
+    pytest.importorskip("numba")
+    from sklearn.ensemble import RandomForestRegressor
+    
+    rng = np.random.default_rng(0)
+    X = np.round(rng.normal(size=(400, 4)), 1).astype(np.float32)
+    y = 10 * X[:, 0] + X[:, 1] ** 2 + rng.normal(size=400)
+    forest = RandomForestRegressor(n_estimators=10, max_depth=8, random_state=0).fit(X, y)
+    
+    # Put rows exactly on, and one float32 step either side of, every split
+    # threshold as sklearn sees it after casting inputs to float32
+    rows = []
+    for est in forest.estimators_:
+        tree = est.tree_
+        for node in np.flatnonzero(tree.children_left != -1):
+            t32 = np.float32(tree.threshold[node])
+            for value in (np.nextafter(t32, np.float32(-np.inf)), t32, np.nextafter(t32, np.float32(np.inf))):
+                row = X[rng.integers(len(X))].copy()
+                row[tree.feature[node]] = value
+                rows.append(row)
+    rows = np.ascontiguousarray(rows, dtype=np.float32)
+    
+    packed = prediction_server.pack_forest(forest)
+    assert packed is not None
+    monkeypatch.setattr(prediction_server, "FOREST", packed)
+    # Large batches are split across threads by row, small ones by tree
+    assert len(rows) >= prediction_server.FOREST_ROW_PARALLEL_MIN
+    np.testing.assert_allclose(prediction_server.predict_rows(rows), forest.predict(rows), rtol=1e-6, atol=1e-5)
+    small = rows[:prediction_server.FOREST_ROW_PARALLEL_MIN - 1]
+    np.testing.assert_allclose(prediction_server.predict_rows(small), forest.predict(small), rtol=1e-6, atol=1e-5)
+
+
+def test_feature_statistics_merge(monkeypatch):
+    """Test that merged pending batches match the statistics of all rows"""
+    monkeypatch.setattr(prediction_server, "FEATURE_STATS_SHM", "")
+    monkeypatch.setattr(prediction_server, "feature_names", ["a", "b", "c"])
+    prediction_server.init_feature_statistics(["a", "b", "c"])
+    rng = np.random.default_rng(0)
+    rows = rng.normal([20.0, 60.0, 1010.0], [5.0, 15.0, 8.0], size=(100, 3))
+    
+    try:
+        # Uneven batches: flushes at every STATS_FLUSH_INTERVAL plus partial ones
+        for batch in np.split(rows, [7, 40, 41, 90]):
+            for x in batch:
+                prediction_server.detect_data_drift(x)
+            prediction_server.flush_feature_statistics()
+        
+        assert (prediction_server._count == len(rows)).all()
+        np.testing.assert_allclose(prediction_server._mean, rows.mean(axis=0))
+        np.testing.assert_allclose(prediction_server._m2 / (prediction_server._count - 1),
+                                   rows.var(axis=0, ddof=1))
+    finally:
+        prediction_server.init_feature_statistics(None)